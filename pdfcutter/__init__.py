@@ -1,3 +1,5 @@
 __version__ = '0.0.1'
 
 from .pdfcutter import PDFCutter  # noqa
+from .incremental import PageResultStore  # noqa
+from .table import ColumnLayout  # noqa
@@ -0,0 +1,41 @@
+import argparse
+import logging
+
+from .server import serve
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pdfcutter')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser(
+        'serve', help='Keep parsed documents loaded and answer queries'
+    )
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--socket', dest='socket_path',
+                              help='Listen on a Unix socket instead')
+    serve_parser.add_argument('--max-documents', type=int, default=16)
+    serve_parser.add_argument('--max-memory', type=int, default=None,
+                              help='Pool size limit in megabytes')
+    serve_parser.add_argument('--workers', type=int, default=2,
+                              help='Parallel PDF conversions')
+    serve_parser.add_argument('--queue-size', type=int, default=8,
+                              help='Conversions allowed to wait for a worker')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    max_bytes = None
+    if args.max_memory is not None:
+        max_bytes = args.max_memory * 1024 * 1024
+    serve(
+        host=args.host, port=args.port, socket_path=args.socket_path,
+        max_documents=args.max_documents, max_bytes=max_bytes,
+        workers=args.workers, queue_size=args.queue_size
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+from collections import OrderedDict
+import functools
+import sys
+
+
+class SelectionKey(object):
+    """
+    Identity of a selection's elements for use in cache keys. Holds the
+    selection's own element list instead of a copy and hashes element
+    ids, which stay unique as long as the elements are referenced.
+    """
+    __slots__ = ('elements', 'hash')
+
+    def __init__(self, elements):
+        self.elements = elements
+        self.hash = hash(frozenset(map(id, elements)))
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if not isinstance(other, SelectionKey):
+            return False
+        if self.elements is other.elements:
+            return True
+        return (self.hash == other.hash and
+                len(self.elements) == len(other.elements) and
+                set(map(id, self.elements)) == set(map(id, other.elements)))
+
+
+def key_parts(key):
+    if isinstance(key, SelectionKey):
+        yield key
+    elif isinstance(key, (tuple, frozenset)):
+        for part in key:
+            for k in key_parts(part):
+                yield k
+
+
+def normalize(value):
+    if hasattr(value, 'cache_key'):
+        return value.cache_key
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(normalize(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v)) for k, v in value.items()))
+    return value
+
+
+def make_key(name, selection, args, kwargs):
+    key = (name, selection.cache_key, normalize(args), normalize(kwargs))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class QueryCache(object):
+    """
+    Least recently used selections, bounded by number of entries and
+    optionally by the number of elements held. Element lists shared
+    between entries (e.g. the result of `all()` and the keys of every
+    query run on it) are counted once.
+    """
+
+    def __init__(self, maxsize=256, max_elements=None):
+        self.maxsize = maxsize
+        self.max_elements = max_elements
+        self.entries = OrderedDict()
+        # id of element list -> [list, number of entries using it]
+        self.lists = {}
+        self.elements = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        try:
+            selection, _ = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return selection
+
+    def get_lists(self, key, selection):
+        lists = {id(selection.selected): selection.selected}
+        for k in key_parts(key):
+            lists[id(k.elements)] = k.elements
+        return list(lists.values())
+
+    def acquire(self, lists):
+        for lst in lists:
+            if id(lst) in self.lists:
+                self.lists[id(lst)][1] += 1
+            else:
+                self.lists[id(lst)] = [lst, 1]
+                self.elements += len(lst)
+
+    def release(self, lists):
+        for lst in lists:
+            entry = self.lists[id(lst)]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.lists[id(lst)]
+                self.elements -= len(lst)
+
+    def set(self, key, selection):
+        if key in self.entries:
+            self.release(self.entries.pop(key)[1])
+        lists = self.get_lists(key, selection)
+        added = sum(len(lst) for lst in lists if id(lst) not in self.lists)
+        if self.max_elements is not None and added > self.max_elements:
+            return
+        self.entries[key] = (selection, lists)
+        self.acquire(lists)
+        while len(self.entries) > 1 and (
+                len(self.entries) > self.maxsize or (
+                    self.max_elements is not None and
+                    self.elements > self.max_elements)):
+            _, (_, evicted_lists) = self.entries.popitem(last=False)
+            self.release(evicted_lists)
+            self.evictions += 1
+
+    def memory_usage(self):
+        size = sys.getsizeof(self.entries) + sys.getsizeof(self.lists)
+        for lst, _ in self.lists.values():
+            size += sys.getsizeof(lst)
+        for key, (selection, _) in self.entries.items():
+            size += sys.getsizeof(key) + sys.getsizeof(selection) + sum(
+                sys.getsizeof(k) for k in key_parts(key)
+            )
+        return size
+
+    def clear(self):
+        self.entries.clear()
+        self.lists.clear()
+        self.elements = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'elements': self.elements,
+        }
+
+
+def cached_query(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = self.cutter.query_cache
+        if cache is None:
+            return method(self, *args, **kwargs)
+        key = make_key(method.__name__, self, args, kwargs)
+        if key is None:
+            return method(self, *args, **kwargs)
+        result = cache.get(key)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            cache.set(key, result)
+        return result
+    return wrapper
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+from lxml import etree
+
+from .pdfcutter import Selection
+
+MISSING = object()
+
+
+def get_page_elements(cutter, page, boilerplate=True):
+    """
+    The elements of a page an extraction function gets to see: its text
+    elements, without detected boilerplate unless `boilerplate` is true.
+    """
+    return [
+        el for el in page if el.tag == 'text' and (
+            boilerplate or el not in cutter.boilerplate
+        )
+    ]
+
+
+def page_fingerprint(page, elements, fonts):
+    """
+    Hash the page size and the given elements of a page. Font ids are
+    replaced by their font specification and the page number is left
+    out, so the same content gets the same fingerprint when pages or
+    fonts are added before it.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((page.get('width'), page.get('height'))).encode())
+    for el in elements:
+        attrib = dict(el.attrib)
+        if 'font' in attrib:
+            spec = fonts.get(attrib['font'], {})
+            attrib['font'] = sorted(
+                (k, v) for k, v in spec.items() if k != 'id'
+            )
+        digest.update(repr((el.tag, sorted(attrib.items()))).encode())
+        digest.update((el.text or '').encode('utf-8'))
+        for child in el:
+            digest.update(etree.tostring(child))
+    return digest.hexdigest()
+
+
+def get_page_fingerprints(cutter, boilerplate=True):
+    fonts = cutter.collect_fontspecs()
+    return OrderedDict(
+        (int(page.attrib['number']), page_fingerprint(
+            page, get_page_elements(cutter, page, boilerplate), fonts
+        ))
+        for page in cutter.root.xpath('//page')
+    )
+
+
+class PageResultStore(object):
+    """
+    Extraction results per page fingerprint, grouped by a namespace
+    that names the extraction. Stored as JSON if a path is given.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.results = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.results = json.load(f)
+
+    def get(self, namespace, fingerprint, default=None):
+        return self.results.get(namespace, {}).get(fingerprint, default)
+
+    def set(self, namespace, fingerprint, result):
+        self.results.setdefault(namespace, {})[fingerprint] = result
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.results, f)
+        os.replace(tmp_path, self.path)
+
+
+def extract_pages(cutter, func, store, namespace, pages=None,
+                  processes=None, boilerplate=False):
+    fingerprints = get_page_fingerprints(cutter, boilerplate=boilerplate)
+    if pages is None:
+        pages = list(fingerprints)
+    pages = sorted(set(pages))
+
+    results = {}
+    changed = []
+    for number in pages:
+        result = store.get(namespace, fingerprints[number], MISSING)
+        if result is MISSING:
+            changed.append(number)
+        else:
+            results[number] = result
+
+    # Extraction functions see exactly the elements that were hashed
+    if processes is not None:
+        computed = cutter.map_pages(
+            func, pages=changed, processes=processes,
+            boilerplate=boilerplate
+        )
+    else:
+        page_elements = {
+            int(p.attrib['number']): p for p in cutter.root.xpath('//page')
+        }
+        computed = [
+            func(Selection(
+                get_page_elements(cutter, page_elements[n], boilerplate),
+                cutter=cutter
+            ))
+            for n in changed
+        ]
+    for number, result in zip(changed, computed):
+        store.set(namespace, fingerprints[number], result)
+        results[number] = result
+    store.save()
+    return [results[number] for number in pages]
@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import itertools
+import math
+import os
+
+from lxml import etree
+
+from .pdfcutter import PDFCutter, Selection
+
+
+def get_page_runs(numbers):
+    """
+    Split sorted page numbers into runs of consecutive pages.
+    """
+    runs = []
+    for number in numbers:
+        if runs and runs[-1][-1] == number - 1:
+            runs[-1].append(number)
+        else:
+            runs.append([number])
+    return runs
+
+
+def serialize_page(cutter, page, boilerplate=True):
+    if not boilerplate and cutter.boilerplate:
+        page_copy = copy.deepcopy(page)
+        for el, el_copy in zip(list(page), list(page_copy)):
+            if el in cutter.boilerplate:
+                page_copy.remove(el_copy)
+        page = page_copy
+    return etree.tostring(page, with_tail=False)
+
+
+def make_shards(cutter, pages, pages_per_shard, boilerplate=True):
+    """
+    Serialize requested pages to small standalone documents of at most
+    `pages_per_shard` consecutive pages, each with the document offset
+    of its first page. Font specifications of the whole document are
+    copied into every shard.
+    """
+    page_elements = {}
+    page_offsets = {}
+    for page, offset in zip(cutter.root.xpath('//page'), cutter.offsets):
+        page_elements[int(page.attrib['number'])] = page
+        page_offsets[int(page.attrib['number'])] = offset
+    fontspecs = b''.join(
+        etree.tostring(f, with_tail=False)
+        for f in cutter.root.xpath('//fontspec')
+    )
+    for run in get_page_runs(sorted(pages)):
+        for i in range(0, len(run), pages_per_shard):
+            numbers = run[i:i + pages_per_shard]
+            xml = b''.join(itertools.chain(
+                [b'<pdf2xml>', fontspecs],
+                (serialize_page(cutter, page_elements[n], boilerplate)
+                 for n in numbers),
+                [b'</pdf2xml>']
+            ))
+            yield xml, page_offsets[numbers[0]]
+
+
+def run_shard(func, shard):
+    xml, offset = shard
+    cutter = PDFCutter(xml=xml, low_memory=True)
+    cutter.offsets = [o + offset for o in cutter.offsets]
+    results = []
+    for page in cutter.root.xpath('//page'):
+        selection = Selection(
+            [el for el in page if el.tag == 'text'], cutter=cutter
+        )
+        results.append(func(selection))
+    return results
+
+
+def map_pages(cutter, func, pages=None, processes=None,
+              pages_per_shard=None, boilerplate=True):
+    if pages is None:
+        pages = [int(p.attrib['number'])
+                 for p in cutter.root.xpath('//page')]
+    pages = sorted(set(pages))
+    if not pages:
+        return []
+    if pages_per_shard is None:
+        workers = processes or os.cpu_count() or 1
+        pages_per_shard = max(1, math.ceil(len(pages) / (workers * 4)))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        shards = make_shards(cutter, pages, pages_per_shard,
+                             boilerplate=boilerplate)
+        results = executor.map(run_shard, itertools.repeat(func), shards)
+        return list(itertools.chain.from_iterable(results))
@@ -1,20 +1,29 @@
+from collections import OrderedDict
 import functools
+import gzip
 import logging
+import mmap
 import operator
+import os
 import re
 import subprocess
+import sys
 
 from lxml import etree
 
+from .cache import QueryCache, SelectionKey, cached_query
+from .spatial import SpatialIndex
+from .table import ColumnLayout
 from .utils import (
     fuzzy_compare, overlap_horizontal, overlap_vertical,
-    repr_ascii, similar, get_compare,
-    remove_hyphenation, remove_multispace
+    repr_ascii, similar, get_compare, cluster_positions,
+    remove_hyphenation, remove_multispace, tree_size
 )
 
 logger = logging.getLogger(__name__)
 
 REGEXP_NS = "http://exslt.org/regular-expressions"
+NUMBERS = re.compile(r'\d+')
 
 COMPARISONS = {
     'gt': operator.gt,
@@ -30,34 +39,149 @@ def get_page_number_for_item(item):
     return int(item.getparent().attrib['number'])
 
 
+def get_layout_text(el, top, page_height, margin=0.1):
+    """
+    Text of an element with numbers replaced inside the top and bottom
+    `margin` of its page, where page numbers and dates change from page
+    to page.
+    """
+    text = remove_multispace(
+        etree.tostring(el, method='text', encoding='unicode',
+                       with_tail=False).strip()
+    )
+    if margin and (top < page_height * margin or
+                   page_height - top < page_height * margin):
+        text = NUMBERS.sub('#', text)
+    return text
+
+
+def get_parser():
+    return etree.XMLParser(huge_tree=True)
+
+
+def parse_xml(fileobj, chunk_size=1 << 20):
+    parser = get_parser()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        parser.feed(chunk)
+    return parser.close()
+
+
 class PDFCutter(object):
     tags = ['text', 'image']
 
-    def __init__(self, filename=None, xml=None):
+    def __init__(self, filename=None, xml=None, low_memory=False, root=None):
         self.filename = filename
-        if filename is not None:
-            xml_bytes = PDFCutter.convert_pdf(filename)
-            self.xml = xml_bytes
-        elif xml is not None:
-            if isinstance(xml, str):
-                xml = xml.encode('utf-8')
-            self.xml = xml
+        self.low_memory = low_memory
+        self.xml = None
+        if root is not None:
+            self.root = root
+        elif filename is not None and low_memory:
+            self.root = PDFCutter.parse_pdf(filename)
         else:
-            raise ValueError('No PDF filename or xml given')
-        self.root = etree.fromstring(self.xml)
+            if filename is not None:
+                xml_bytes = PDFCutter.convert_pdf(filename)
+                self.xml = xml_bytes
+            elif xml is not None:
+                if isinstance(xml, str):
+                    xml = xml.encode('utf-8')
+                self.xml = xml
+            else:
+                raise ValueError('No PDF filename or xml given')
+            self.root = etree.fromstring(self.xml, parser=get_parser())
+        if low_memory:
+            self.xml = None
+            self.compact_tree()
         self.pages = {}
         self.fonts = None
         self.offsets = list(self.get_offsets())
+        self.first_page = self.get_first_page_number()
+        self._spatial_index = None
+        self._tree_size = None
+        self.boilerplate = set()
+        self.query_cache = None
 
     def __str__(self):
         if self.filename:
             return '<PDFCutter filename="{}">'.format(self.filename)
+        if self.xml is None:
+            return '<PDFCutter pages={}>'.format(len(self.offsets))
         return '<PDFCutter xml=({} chars)>'.format(len(self.xml))
     __repr__ = __str__
 
+    def compact_tree(self):
+        # Whitespace between elements and the constant page position
+        # are never used for queries
+        etree.strip_attributes(self.root, 'position')
+        self.root.text = None
+        for page in self.root:
+            page.text = None
+            page.tail = None
+            for el in page:
+                el.tail = None
+
+    def memory_usage(self):
+        """
+        Estimated bytes held by this document, per component. The size
+        of the lxml tree is estimated from libxml2's node sizes.
+        """
+        usage = OrderedDict()
+        usage['xml'] = sys.getsizeof(self.xml) if self.xml is not None else 0
+        if self._tree_size is None:
+            # The tree does not change after parsing
+            self._tree_size = tree_size(self.root)
+        usage['tree'] = self._tree_size
+        # Page wrappers and offsets all have the same size
+        usage['pages'] = sys.getsizeof(self.pages)
+        if self.pages:
+            page = next(iter(self.pages.values()))
+            usage['pages'] += len(self.pages) * (
+                sys.getsizeof(page) + sys.getsizeof(page.__dict__)
+            )
+        usage['fonts'] = 0
+        if self.fonts is not None:
+            usage['fonts'] = sys.getsizeof(self.fonts) + sum(
+                sys.getsizeof(f) for f in self.fonts.values()
+            )
+        usage['offsets'] = sys.getsizeof(self.offsets) + (
+            len(self.offsets) * sys.getsizeof(0.0)
+        )
+        usage['spatial_index'] = 0
+        if self._spatial_index is not None:
+            usage['spatial_index'] = self._spatial_index.memory_usage()
+        usage['boilerplate'] = sys.getsizeof(self.boilerplate)
+        usage['query_cache'] = 0
+        if self.query_cache is not None:
+            usage['query_cache'] = self.query_cache.memory_usage()
+        usage['total'] = sum(usage.values())
+        return usage
+
     @classmethod
-    def convert_pdf(cls, filename, binary='pdftohtml',
-                    ignore_images=True, hidden_text=True):
+    def from_file(cls, source, low_memory=False, use_mmap=False):
+        """
+        Parse converted XML from a path (gzip compressed if it ends in
+        `.gz`) or a binary file object in chunks, without reading the
+        whole document into memory first.
+        """
+        if hasattr(source, 'read'):
+            return cls(root=parse_xml(source), low_memory=low_memory)
+        source = os.fspath(source)
+        if source.endswith('.gz'):
+            if use_mmap:
+                raise ValueError('Cannot memory-map compressed XML')
+            with gzip.open(source, 'rb') as f:
+                root = parse_xml(f)
+        elif use_mmap:
+            with open(source, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    root = parse_xml(m)
+        else:
+            with open(source, 'rb') as f:
+                root = parse_xml(f)
+        return cls(root=root, low_memory=low_memory)
+
+    @classmethod
+    def get_convert_args(cls, filename, binary='pdftohtml',
+                         ignore_images=True, hidden_text=True):
         args = [
             binary,
             '-xml',
@@ -69,9 +193,42 @@ class PDFCutter(object):
             args.append('-hidden')
 
         args.append(filename)
+        return args
+
+    @classmethod
+    def convert_pdf(cls, filename, binary='pdftohtml',
+                    ignore_images=True, hidden_text=True):
+        args = cls.get_convert_args(
+            filename, binary=binary,
+            ignore_images=ignore_images, hidden_text=hidden_text
+        )
         xml_bytes = subprocess.check_output(args)
         return xml_bytes
 
+    @classmethod
+    def parse_pdf(cls, filename, binary='pdftohtml',
+                  ignore_images=True, hidden_text=True):
+        """
+        Convert a PDF and parse the XML while it is read from the
+        converter's output.
+        """
+        args = cls.get_convert_args(
+            filename, binary=binary,
+            ignore_images=ignore_images, hidden_text=hidden_text
+        )
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        try:
+            root = parse_xml(proc.stdout)
+        except etree.XMLSyntaxError:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, args)
+            raise
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+        return root
+
     def get_offsets(self):
         offset = 0
         for p in self.root.xpath('//page'):
@@ -83,12 +240,82 @@ class PDFCutter(object):
             ' or '.join('self::{}'.format(t) for t in self.tags)
         )
 
-    def all(self):
+    def all(self, boilerplate=True):
+        key = ('all', bool(boilerplate))
+        if self.query_cache is not None:
+            selection = self.query_cache.get(key)
+            if selection is not None:
+                return selection
         all_elements = self.root.xpath(self.all_elements_xpath())
-        return Selection(all_elements, cutter=self)
-
-    def filter(self, **kwargs):
-        return self.all().filter(**kwargs)
+        if not boilerplate and self.boilerplate:
+            all_elements = [el for el in all_elements
+                            if el not in self.boilerplate]
+        selection = Selection(all_elements, cutter=self)
+        if self.query_cache is not None:
+            self.query_cache.set(key, selection)
+        return selection
+
+    def enable_cache(self, maxsize=256, max_elements=None):
+        """
+        Memoize selections returned by `all`, `filter` and the relational
+        methods. The tree does not change after parsing, so results only
+        depend on the query and the selection it ran on.
+        """
+        self.query_cache = QueryCache(
+            maxsize=maxsize, max_elements=max_elements
+        )
+        return self.query_cache
+
+    def filter(self, boilerplate=True, **kwargs):
+        return self.all(boilerplate=boilerplate).filter(**kwargs)
+
+    def detect_boilerplate(self, min_pages=3, ratio=0.5, tolerance=4,
+                           margin=0.1):
+        """
+        Mark elements that repeat on many pages at the same position,
+        measured from the top or bottom edge of their page and aligned
+        left, right or centered. Text has to match exactly, except inside
+        the top and bottom `margin` of a page where numbers may differ
+        (page numbers, dates).
+        """
+        groups = {}
+        for el in self.root.xpath(self.all_elements_xpath()):
+            page = self.get_page_for_item(el)
+            top = int(el.attrib.get('top', 0))
+            left = int(el.attrib.get('left', 0))
+            right = left + int(el.attrib.get('width', 0))
+            text = get_layout_text(el, top, page.height, margin=margin)
+            groups.setdefault((el.tag, text), []).append((
+                page.number, top, page.height - top,
+                left, right, (left + right) / 2, el
+            ))
+
+        needed = max(min_pages, ratio * self.num_pages)
+
+        def count_pages(items):
+            return len(set(item[0] for item in items))
+
+        boilerplate = set()
+        for items in groups.values():
+            if count_pages(items) < needed:
+                continue
+            # vertical distance from top or bottom edge, then left, right
+            # or center alignment
+            for vertical in (1, 2):
+                for row in cluster_positions(items, vertical, tolerance):
+                    if count_pages(row) < needed:
+                        continue
+                    for horizontal in (3, 4, 5):
+                        for cluster in cluster_positions(row, horizontal,
+                                                         tolerance):
+                            if count_pages(cluster) >= needed:
+                                boilerplate.update(
+                                    item[-1] for item in cluster
+                                )
+        self.boilerplate = boilerplate
+        if self.query_cache is not None:
+            self.query_cache.clear()
+        return Selection(list(boilerplate), cutter=self)
 
     def get_page_for_item(self, item):
         page_number = get_page_number_for_item(item)
@@ -96,8 +323,59 @@ class PDFCutter(object):
             self.pages[page_number] = Page.from_item(item)
         return self.pages[page_number]
 
+    def get_first_page_number(self):
+        pages = self.root.xpath('//page[1]/@number')
+        if not pages:
+            return 1
+        return int(pages[0])
+
     def get_offset_for_page(self, page):
-        return self.offsets[page.number - 1]
+        return self.offsets[page.number - self.first_page]
+
+    def map_pages(self, func, pages=None, processes=None,
+                  pages_per_shard=None, boilerplate=True):
+        """
+        Call `func` with a selection of the text elements of each page
+        in a pool of processes and return the results in page order.
+        Pages are shipped to the workers as serialized XML; `func` and
+        its results need to be picklable.
+        """
+        from .parallel import map_pages
+
+        return map_pages(
+            self, func, pages=pages, processes=processes,
+            pages_per_shard=pages_per_shard, boilerplate=boilerplate
+        )
+
+    def page_fingerprints(self, boilerplate=True):
+        from .incremental import get_page_fingerprints
+
+        return get_page_fingerprints(self, boilerplate=boilerplate)
+
+    def extract_pages(self, func, store, namespace, pages=None,
+                      processes=None, boilerplate=False):
+        """
+        Like `map_pages`, but results are looked up in `store` by page
+        fingerprint first and only pages whose content changed are
+        processed. Detected boilerplate (run `detect_boilerplate` first)
+        is left out of both the fingerprint and the selection passed to
+        `func`, so changing page numbers do not invalidate results.
+        Results should not depend on other pages (e.g. use `top`, not
+        `doc_top`) and need to be JSON serializable if the store is
+        saved to disk.
+        """
+        from .incremental import extract_pages
+
+        return extract_pages(
+            self, func, store, namespace, pages=pages, processes=processes,
+            boilerplate=boilerplate
+        )
+
+    @property
+    def spatial_index(self):
+        if self._spatial_index is None:
+            self._spatial_index = SpatialIndex.from_cutter(self)
+        return self._spatial_index
 
     @property
     def num_pages(self):
@@ -169,6 +447,8 @@ class Selection(object):
 
         self.selected = selected
         self.pages = set(self.cutter.get_page_for_item(s) for s in selected)
+        self._cache_key = None
+        self._element_set = None
 
     def __repr__(self):
         return '<{}({}, {}, {}, {}) \'{}\'>'.format(
@@ -285,6 +565,18 @@ class Selection(object):
     def doc_midy(self):
         return (self.doc_top + self.doc_bottom) / 2
 
+    @property
+    def element_set(self):
+        if self._element_set is None:
+            self._element_set = set(self.selected)
+        return self._element_set
+
+    @property
+    def cache_key(self):
+        if self._cache_key is None:
+            self._cache_key = SelectionKey(self.selected)
+        return self._cache_key
+
     @property
     def elements(self):
         return self.selected
@@ -295,8 +587,10 @@ class Selection(object):
             return self.selected[0]
         return None
 
+    @cached_query
     def filter(self, search=None, auto_regex=None, regex=None, xpath=None,
-               tag='text', page=None, pages=None, check=None, **kwargs):
+               tag='text', page=None, pages=None, check=None,
+               boilerplate=True, only_boilerplate=False, **kwargs):
         if search is not None:
             # FIXME: very poor escaping try ahead
             logger.debug('Searching %s', repr_ascii(search))
@@ -342,6 +636,10 @@ class Selection(object):
 
         result = []
         for item in self.selected:
+            if not boilerplate and item in self.cutter.boilerplate:
+                continue
+            if only_boilerplate and item not in self.cutter.boilerplate:
+                continue
             selitem = cls(item, self.cutter)
             if check is not None and not check(selitem):
                 continue
@@ -371,6 +669,7 @@ class Selection(object):
             condition(s)
         ], cutter=self.cutter)
 
+    @cached_query
     def left_of(self, selection):
         if isinstance(selection, (int, float)):
             return self.filter_condition(lambda s: s.right < selection)
@@ -378,6 +677,7 @@ class Selection(object):
             return self.empty()
         return self.filter_condition(lambda s: s.right < selection.left)
 
+    @cached_query
     def strictly_left_of(self, selection, mid_point=False):
         if not selection:
             return self.empty()
@@ -386,6 +686,7 @@ class Selection(object):
             s.right < selection.left
         )
 
+    @cached_query
     def right_of(self, selection):
         if isinstance(selection, (int, float)):
             return self.filter_condition(lambda s: s.left > selection)
@@ -393,6 +694,7 @@ class Selection(object):
             return self.empty()
         return self.filter_condition(lambda s: s.left > selection.right)
 
+    @cached_query
     def strictly_right_of(self, selection, mid_point=False):
         if not selection:
             return self.empty()
@@ -401,6 +703,7 @@ class Selection(object):
             s.left > selection.right
         )
 
+    @cached_query
     def below(self, selection):
         if isinstance(selection, (int, float)):
             return self.filter_condition(lambda s: s.doc_top > selection)
@@ -410,6 +713,7 @@ class Selection(object):
             lambda s: s.doc_top > selection.doc_bottom
         )
 
+    @cached_query
     def stricly_below(self, selection, mid_point=False):
         if not selection:
             return self.empty()
@@ -418,6 +722,7 @@ class Selection(object):
             s.doc_top > selection.doc_bottom
         )
 
+    @cached_query
     def above(self, selection):
         if isinstance(selection, (int, float)):
             return self.filter_condition(lambda s: s.doc_bottom < selection)
@@ -427,6 +732,7 @@ class Selection(object):
             lambda s: s.doc_bottom < selection.doc_top
         )
 
+    @cached_query
     def stricly_above(self, selection, mid_point=False):
         if not selection:
             return self.empty()
@@ -435,6 +741,47 @@ class Selection(object):
             s.doc_bottom < selection.doc_top
         )
 
+    def get_nearest_elements(self, anchor, direction=None, k=1,
+                             max_distance=None, strict=False):
+        if not anchor:
+            return []
+        box = (anchor.left, anchor.right, anchor.doc_top, anchor.doc_bottom)
+        index = self.cutter.spatial_index
+        candidates = None
+        if len(self.selected) != len(index):
+            candidates = self.element_set
+        return index.nearest(
+            box, direction=direction, k=k, max_distance=max_distance,
+            strict=strict, candidates=candidates,
+            exclude=set(anchor.selected)
+        )
+
+    @cached_query
+    def nearest(self, anchor, direction=None, k=1, max_distance=None,
+                strict=False):
+        """
+        The `k` elements closest to `anchor` as one selection, which
+        like every selection is in reading order. Use `nearest_ranked`
+        to get them ordered by distance.
+        """
+        result = self.get_nearest_elements(
+            anchor, direction=direction, k=k, max_distance=max_distance,
+            strict=strict
+        )
+        return type(self)(result, cutter=self.cutter)
+
+    def nearest_ranked(self, anchor, direction=None, k=1, max_distance=None,
+                       strict=False):
+        """
+        The `k` elements closest to `anchor` as a list of selections,
+        closest first.
+        """
+        result = self.get_nearest_elements(
+            anchor, direction=direction, k=k, max_distance=max_distance,
+            strict=strict
+        )
+        return [type(self)(el, cutter=self.cutter) for el in result]
+
     def empty(self):
         return type(self)([], cutter=self.cutter)
 
@@ -456,9 +803,8 @@ class Selection(object):
 
     def text_list(self, join_words=True):
         texts = [etree.tostring(
-            t, method="text", encoding='utf-8').decode('utf-8')
-            for t in self.selected
-        ]
+            t, method="text", encoding='utf-8', with_tail=False
+        ).decode('utf-8') for t in self.selected]
         if join_words:
             return [t.strip().replace('- ', '-') for t in texts]
         return texts
@@ -476,14 +822,13 @@ class Selection(object):
             current_line.extend(el.selected)
         yield type(self)(current_line, self.cutter)
 
-    def get_table(self, number_of_columns=None, row_threshold=10,
-                  is_garbage=lambda x: False):
+    def get_rows(self, row_threshold=10):
         current_row_top = None
         current_row = []
         data = []
         cls = self.__class__
         for el in self.selected:
-            el = cls(el)
+            el = cls(el, self.cutter)
             midrow = el.doc_top
             if current_row_top is None:
                 current_row_top = midrow
@@ -498,48 +843,32 @@ class Selection(object):
                     current_row_top = midrow
             current_row.append(el)
         data.append(current_row)
+        return data
 
-        max_cols = number_of_columns or max([len(row) for row in data])
-        col_layout = [(float('inf'), -float('inf'))] * max_cols
-        # try to detect columns
-        for row in data:
-            if len(row) == max_cols:
-                new_col_layout = []
-                for lay, col in zip(col_layout, row):
-                    new_col_layout.append((
-                        min(lay[0], col.left),
-                        max(lay[1], col.right)
-                    ))
-                col_layout = new_col_layout
-
-        # close gaps in column layout
-        col_layout = new_col_layout
-        new_col_layout = []
-        for i, lay in enumerate(col_layout):
-            if i == 0:
-                left = self.left
-            else:
-                left = (col_layout[i - 1][1] + lay[0]) / 2
-
-            if i == len(col_layout) - 1:
-                right = self.right
-            else:
-                right = (col_layout[i + 1][0] + lay[1]) / 2
+    def get_column_layout(self, number_of_columns=None, row_threshold=10):
+        return ColumnLayout.detect(
+            self.get_rows(row_threshold=row_threshold),
+            number_of_columns=number_of_columns
+        )
 
-            new_col_layout.append((left, right))
-        col_layout = new_col_layout
+    def get_table(self, number_of_columns=None, row_threshold=10,
+                  is_garbage=lambda x: False, layout=None):
+        data = self.get_rows(row_threshold=row_threshold)
+        if layout is None:
+            layout = ColumnLayout.detect(
+                data, number_of_columns=number_of_columns
+            )
 
         new_data = []
 
         for row in data:
             new_row = []
             for cell in row:
-                matching_col = [i for i, c in enumerate(col_layout)
-                                if c[0] <= cell.midx <= c[1]]
-                if matching_col:
-                    new_row.extend([None] * (matching_col[0] - len(new_row)))
+                col = layout.get_column(cell.midx)
+                if col is not None:
+                    new_row.extend([None] * (col - len(new_row)))
                     new_row.append(cell.text())
-            new_row.extend([None] * (len(col_layout) - len(new_row)))
+            new_row.extend([None] * (len(layout) - len(new_row)))
             new_data.append(new_row)
 
         data = new_data
@@ -566,7 +895,7 @@ class Selection(object):
         new_data = [[] for i in range(len(data))]
 
         # Clean columns
-        for i in range(len(col_layout)):
+        for i in range(len(layout)):
             if not all([not row[i] or is_garbage(row[i]) for row in data]):
                 for newrow, row in zip(new_data, data):
                     newrow.append(row[i])
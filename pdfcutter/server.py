@@ -0,0 +1,265 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import logging
+import os
+import re
+import socketserver
+import subprocess
+import threading
+import types
+
+from lxml import etree
+
+from .pdfcutter import PDFCutter, Selection
+
+logger = logging.getLogger(__name__)
+
+QUERY_METHODS = {
+    'filter', 'nearest', 'nearest_ranked',
+    'left_of', 'strictly_left_of', 'right_of', 'strictly_right_of',
+    'above', 'stricly_above', 'below', 'stricly_below',
+    'get_by_line', 'get_table', 'text', 'clean_text', 'text_list',
+}
+
+
+class PoolBusy(Exception):
+    pass
+
+
+def file_hash(filename, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def document_size(cutter):
+    return cutter.memory_usage()['total']
+
+
+class Document(object):
+    def __init__(self, key, cutter, size):
+        self.key = key
+        self.cutter = cutter
+        self.size = size
+        self.lock = threading.Lock()
+
+
+class DocumentPool(object):
+    """
+    Parsed documents keyed by content hash, evicted least recently used
+    first. Conversions run on a thread pool; once all workers are busy
+    and `queue_size` loads are waiting, new loads are refused.
+    """
+
+    def __init__(self, max_documents=16, max_bytes=None, workers=2,
+                 queue_size=8, cache_size=256, low_memory=True):
+        self.max_documents = max_documents
+        self.low_memory = low_memory
+        self.max_bytes = max_bytes
+        self.cache_size = cache_size
+        self.documents = OrderedDict()
+        self.size = 0
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def get(self, filename=None, xml=None, xml_path=None):
+        if filename is not None:
+            key = file_hash(filename)
+        elif xml_path is not None:
+            key = file_hash(xml_path)
+        elif xml is not None:
+            if isinstance(xml, str):
+                xml = xml.encode('utf-8')
+            key = hashlib.sha256(xml).hexdigest()
+        else:
+            raise ValueError('No PDF filename, xml or xml_path given')
+
+        with self.lock:
+            if key in self.documents:
+                self.documents.move_to_end(key)
+                return self.documents[key]
+            future = self.loading.get(key)
+            if future is None:
+                if not self.slots.acquire(blocking=False):
+                    raise PoolBusy('Too many documents waiting for conversion')
+                future = self.executor.submit(
+                    self.load, key, filename, xml, xml_path
+                )
+                self.loading[key] = future
+        return future.result()
+
+    def load(self, key, filename, xml, xml_path):
+        try:
+            if xml_path is not None:
+                cutter = PDFCutter.from_file(
+                    xml_path, low_memory=self.low_memory
+                )
+            else:
+                cutter = PDFCutter(filename=filename, xml=xml,
+                                   low_memory=self.low_memory)
+            if self.cache_size:
+                cutter.enable_cache(maxsize=self.cache_size)
+            document = Document(key, cutter, document_size(cutter))
+            with self.lock:
+                self.documents[key] = document
+                self.size += document.size
+                self.evict()
+            return document
+        finally:
+            with self.lock:
+                self.loading.pop(key, None)
+            self.slots.release()
+
+    def resize(self, document):
+        """
+        Update the size of a document after queries grew its spatial
+        index or query cache. Call with the document's lock held.
+        """
+        size = document_size(document.cutter)
+        with self.lock:
+            if self.documents.get(document.key) is document:
+                self.size += size - document.size
+            document.size = size
+            self.evict()
+
+    def evict(self):
+        while len(self.documents) > 1 and (
+                len(self.documents) > self.max_documents or (
+                    self.max_bytes is not None and
+                    self.size > self.max_bytes)):
+            _, document = self.documents.popitem(last=False)
+            self.size -= document.size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'documents': len(self.documents),
+                'bytes': self.size,
+                'loading': len(self.loading),
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def to_json(result):
+    if isinstance(result, Selection):
+        return {'text': result.text(), 'count': len(result)}
+    if isinstance(result, (list, types.GeneratorType)):
+        return [to_json(r) for r in result]
+    return result
+
+
+def run_query(cutter, steps, results):
+    result = cutter.all()
+    for step in steps:
+        if isinstance(step, str):
+            step = [step]
+        method, args = step[0], list(step[1:])
+        if method not in QUERY_METHODS:
+            raise ValueError('Unknown query method {}'.format(method))
+        kwargs = {}
+        if args and isinstance(args[-1], dict):
+            kwargs = args.pop()
+        args = [results[a[1:]] if isinstance(a, str) and a.startswith('$')
+                else a for a in args]
+        if not isinstance(result, Selection):
+            raise ValueError('{} needs a selection'.format(method))
+        result = getattr(result, method)(*args, **kwargs)
+    return result
+
+
+def run_queries(cutter, queries):
+    """
+    Run named queries in order. Each query is a list of steps
+    ``[method, *args, {kwargs}]`` applied to all elements of the
+    document; positional arguments like ``"$label"`` refer to the
+    selection of an earlier query.
+    """
+    results = {}
+    for name, steps in queries.items():
+        results[name] = run_query(cutter, steps, results)
+    return {name: to_json(result) for name, result in results.items()}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'local'
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.send_json(404, {'error': 'Not found'})
+        self.send_json(200, self.server.pool.stats())
+
+    def do_POST(self):
+        if self.path != '/extract':
+            return self.send_json(404, {'error': 'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            queries = data.get('queries', {})
+            document = self.server.pool.get(
+                filename=data.get('path'), xml=data.get('xml'),
+                xml_path=data.get('xml_path')
+            )
+            with document.lock:
+                try:
+                    result = run_queries(document.cutter, queries)
+                finally:
+                    self.server.pool.resize(document)
+        except PoolBusy as e:
+            return self.send_json(503, {'error': str(e)})
+        except (FileNotFoundError, IsADirectoryError) as e:
+            return self.send_json(404, {'error': str(e)})
+        except subprocess.CalledProcessError as e:
+            return self.send_json(500, {'error': str(e)})
+        except (ValueError, KeyError, TypeError, AttributeError,
+                AssertionError, etree.LxmlError, re.error) as e:
+            return self.send_json(400, {'error': str(e) or 'Invalid query'})
+        except Exception as e:
+            logger.exception('Extraction failed')
+            return self.send_json(500, {'error': str(e)})
+        self.send_json(200, result)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(host='127.0.0.1', port=8000, socket_path=None, **pool_kwargs):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, RequestHandler)
+        logger.info('Serving on %s', socket_path)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        logger.info('Serving on http://%s:%s', host, port)
+    server.pool = DocumentPool(**pool_kwargs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
@@ -0,0 +1,167 @@
+import bisect
+import heapq
+import math
+import sys
+
+DIRECTIONS = (None, 'left', 'right', 'above', 'below')
+
+
+def box_distance(a, b):
+    dx = max(0, b[0] - a[1], a[0] - b[1])
+    dy = max(0, b[2] - a[3], a[2] - b[3])
+    return math.hypot(dx, dy)
+
+
+def in_direction(box, anchor, direction, strict=False):
+    if direction is None:
+        return True
+    if direction in ('left', 'right'):
+        if strict and (box[2] > anchor[3] or box[3] < anchor[2]):
+            return False
+        if direction == 'right':
+            return box[0] > anchor[1]
+        return box[1] < anchor[0]
+    if strict and (box[0] > anchor[1] or box[1] < anchor[0]):
+        return False
+    if direction == 'below':
+        return box[2] > anchor[3]
+    return box[3] < anchor[2]
+
+
+class SpatialIndex(object):
+    """
+    Boxes of all elements of a document in document coordinates
+    (left, right, doc_top, doc_bottom), kept sorted by their vertical
+    edges so nearest neighbour queries start with a bisection and stop
+    as soon as no closer box can follow.
+    """
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.by_top = sorted(boxes, key=lambda b: b[2])
+        self.tops = [b[2] for b in self.by_top]
+        self.by_bottom = sorted(boxes, key=lambda b: b[3])
+        self.bottoms = [b[3] for b in self.by_bottom]
+
+    @classmethod
+    def from_cutter(cls, cutter):
+        boxes = []
+        for el in cutter.root.xpath(cutter.all_elements_xpath()):
+            page = cutter.get_page_for_item(el)
+            offset = cutter.get_offset_for_page(page)
+            left = int(el.attrib.get('left', 0))
+            top = int(el.attrib.get('top', 0)) + offset
+            boxes.append((
+                left, left + int(el.attrib.get('width', 0)),
+                top, top + int(el.attrib.get('height', 0)),
+                el
+            ))
+        return cls(boxes)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def memory_usage(self):
+        # The index does not change once built
+        if not hasattr(self, '_memory_usage'):
+            lists = (self.boxes, self.by_top, self.tops, self.by_bottom,
+                     self.bottoms)
+            size = sum(sys.getsizeof(lst) for lst in lists)
+            for box in self.boxes:
+                size += sys.getsizeof(box) + sum(
+                    sys.getsizeof(v) for v in box[:4]
+                )
+            self._memory_usage = size
+        return self._memory_usage
+
+    def scan(self, anchor, direction):
+        """
+        Yield (gap, box) with gap being a lower bound of the distance
+        of this and every following box to the anchor.
+        """
+        if direction == 'below':
+            start = bisect.bisect_right(self.tops, anchor[3])
+            for box in self.by_top[start:]:
+                yield box[2] - anchor[3], box
+        elif direction == 'above':
+            end = bisect.bisect_left(self.bottoms, anchor[2])
+            for box in reversed(self.by_bottom[:end]):
+                yield anchor[2] - box[3], box
+        else:
+            # Walk outwards from the anchor in both directions along the
+            # document, always continuing on the closer side. Boxes to the
+            # left or right are found on the way, so the scan stays within
+            # the vertical band of the best distance found so far
+            mid = bisect.bisect_left(self.tops, anchor[2])
+            lower = mid - 1
+            upper = mid
+            while lower >= 0 or upper < len(self.by_top):
+                lower_gap = upper_gap = float('inf')
+                if lower >= 0:
+                    lower_gap = max(0, anchor[2] - self.tops[lower] -
+                                    self.max_height)
+                if upper < len(self.by_top):
+                    upper_gap = max(0, self.tops[upper] - anchor[3])
+                if lower_gap <= upper_gap:
+                    yield lower_gap, self.by_top[lower]
+                    lower -= 1
+                else:
+                    yield upper_gap, self.by_top[upper]
+                    upper += 1
+
+    @property
+    def min_left(self):
+        if not hasattr(self, '_min_left'):
+            self._min_left = min((b[0] for b in self.boxes), default=0)
+        return self._min_left
+
+    @property
+    def max_right(self):
+        if not hasattr(self, '_max_right'):
+            self._max_right = max((b[1] for b in self.boxes), default=0)
+        return self._max_right
+
+    @property
+    def max_height(self):
+        if not hasattr(self, '_max_height'):
+            self._max_height = max(
+                (b[3] - b[2] for b in self.boxes), default=0
+            )
+        return self._max_height
+
+    def nearest(self, anchor, direction=None, k=1, max_distance=None,
+                strict=False, candidates=None, exclude=()):
+        if direction not in DIRECTIONS:
+            raise ValueError('Unknown direction {}'.format(direction))
+        if max_distance is None:
+            max_distance = float('inf')
+        if direction == 'left' and anchor[0] <= self.min_left:
+            return []
+        if direction == 'right' and anchor[1] >= self.max_right:
+            return []
+        # Strictly left or right boxes overlap the anchor vertically
+        row_only = strict and direction in ('left', 'right')
+        best = []
+        for gap, box in self.scan(anchor, direction):
+            if gap > max_distance:
+                break
+            if row_only and gap > 0:
+                break
+            if len(best) == k and gap > -best[0][0]:
+                break
+            el = box[4]
+            if el in exclude:
+                continue
+            if candidates is not None and el not in candidates:
+                continue
+            if not in_direction(box, anchor, direction, strict=strict):
+                continue
+            distance = box_distance(anchor, box)
+            if distance > max_distance:
+                continue
+            item = (-distance, id(el), el)
+            if len(best) < k:
+                heapq.heappush(best, item)
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, item)
+        return [el for _, _, el in sorted(best, reverse=True)]
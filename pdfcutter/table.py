@@ -0,0 +1,81 @@
+import bisect
+import math
+
+
+class ColumnLayout(object):
+    """
+    Horizontal extent (left, right) of each column of a table. Columns
+    are contiguous and the first and last column are open-ended, so
+    every x position belongs to exactly one column.
+    """
+
+    def __init__(self, columns):
+        self.columns = sorted(tuple(c) for c in columns)
+        self.rights = [c[1] for c in self.columns]
+
+    def __repr__(self):
+        return '<{}({})>'.format(self.__class__.__name__, self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __eq__(self, other):
+        return (isinstance(other, ColumnLayout) and
+                self.columns == other.columns)
+
+    @classmethod
+    def detect(cls, rows, number_of_columns=None):
+        max_cols = number_of_columns or max([len(row) for row in rows])
+        col_layout = None
+        # try to detect columns
+        for row in rows:
+            if len(row) == max_cols:
+                if col_layout is None:
+                    col_layout = [(float('inf'), -float('inf'))] * max_cols
+                new_col_layout = []
+                for lay, col in zip(col_layout, row):
+                    new_col_layout.append((
+                        min(lay[0], col.left),
+                        max(lay[1], col.right)
+                    ))
+                col_layout = new_col_layout
+        if col_layout is None:
+            raise ValueError('No row with {} columns found'.format(max_cols))
+
+        # close gaps in column layout
+        columns = []
+        for i, lay in enumerate(col_layout):
+            if i == 0:
+                col_left = -float('inf')
+            else:
+                col_left = (col_layout[i - 1][1] + lay[0]) / 2
+
+            if i == len(col_layout) - 1:
+                col_right = float('inf')
+            else:
+                col_right = (col_layout[i + 1][0] + lay[1]) / 2
+
+            columns.append((col_left, col_right))
+        return cls(columns)
+
+    @classmethod
+    def from_dict(cls, data):
+        # Open edges are stored as null to keep the data valid JSON
+        return cls([
+            (-float('inf') if left is None else left,
+             float('inf') if right is None else right)
+            for left, right in data['columns']
+        ])
+
+    def to_dict(self):
+        return {'columns': [
+            [None if math.isinf(left) else left,
+             None if math.isinf(right) else right]
+            for left, right in self.columns
+        ]}
+
+    def get_column(self, x):
+        i = bisect.bisect_left(self.rights, x)
+        if i < len(self.columns) and self.columns[i][0] <= x:
+            return i
+        return None
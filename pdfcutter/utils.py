@@ -1,5 +1,8 @@
 import re
 
+# Sizes of libxml2 structs on 64 bit platforms
+XML_NODE_SIZE = 120
+XML_ATTR_SIZE = 96
 
 PDF_HYPHEN = re.compile('(\\w)([\u00AD-]\\s)')
 MULTI_SPACE = re.compile(r' +')
@@ -81,7 +84,36 @@ def fuzzy_compare(a, b):
     return 1 if a[0] > b[0] else -1
 
 
+def cluster_positions(items, index, tolerance):
+    """
+    Split items into clusters of close values at `index`, where
+    neighbouring values are at most `tolerance` apart.
+    """
+    items = sorted(items, key=lambda item: item[index])
+    cluster = []
+    for item in items:
+        if cluster and item[index] - cluster[-1][index] > tolerance:
+            yield cluster
+            cluster = []
+        cluster.append(item)
+    if cluster:
+        yield cluster
+
+
 def get_compare(comp_func, attr, value):
     def compare(item):
         return comp_func(getattr(item, attr), value)
     return compare
+
+
+def tree_size(root):
+    size = 0
+    for el in root.iter():
+        size += XML_NODE_SIZE
+        for value in el.attrib.values():
+            size += XML_ATTR_SIZE + XML_NODE_SIZE + len(value)
+        if el.text:
+            size += XML_NODE_SIZE + len(el.text.encode('utf-8'))
+        if el.tail:
+            size += XML_NODE_SIZE + len(el.tail.encode('utf-8'))
+    return size
@@ -36,6 +36,11 @@ setup(
         'lxml',
     ],
     include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'pdfcutter=pdfcutter.__main__:main',
+        ],
+    },
     classifiers=[
         'Environment :: Console',
         'Intended Audience :: Developers',